@@ -1,17 +1,61 @@
-from fastapi import FastAPI, HTTPException, Body, Path, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi import FastAPI, HTTPException, Body, Path, Query, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Dict, List, Optional, Any, Set
+from fastapi.responses import Response
+from starlette.websockets import WebSocketState
+from pydantic import BaseModel, ConfigDict
+from typing import Callable, Dict, List, Optional, Any, Set, Tuple, Deque, Union
+from collections import defaultdict, deque
+from itertools import islice
+from functools import partial
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager
 import uvicorn
 from datetime import datetime
-import json
 import logging
 import asyncio
+import os
+import time
+import uuid
+import orjson
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Only needed when REDIS_URL is set
+    aioredis = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Set to share rooms, presence, collaboration and chat between workers
+REDIS_URL = os.getenv("REDIS_URL")
+
+# An encoded outgoing frame: str is sent as a text frame, bytes as a binary frame
+Payload = Union[str, bytes]
+
+def encode_message(message: Any) -> Payload:
+    """
+    Serialize an outgoing message once so it can be shared by every recipient.
+    JSON stays a text frame because browser clients JSON.parse(event.data);
+    binary Y.js updates are passed through untouched.
+    """
+    if isinstance(message, (str, bytes)):
+        return message
+    return orjson.dumps(message).decode()
+
+# Last ID handed out by next_id()
+_last_id = 0
+
+def next_id() -> str:
+    """
+    Unique, increasing ID for rooms and chat messages. Starting from the
+    nanosecond clock (rather than a bare counter) keeps IDs from separate
+    workers apart; two IDs in the same nanosecond are bumped by one.
+    """
+    global _last_id
+    _last_id = max(time.time_ns(), _last_id + 1)
+    return str(_last_id)
+
 # --- Data Models ---
 class Room(BaseModel):
     id: str
@@ -24,53 +68,379 @@ class RoomCreate(BaseModel):
     name: str
     description: Optional[str] = None
 
+class RoomUpdate(BaseModel):
+    # Unknown and protected fields (id, created_at) are rejected with a 422
+    model_config = ConfigDict(extra="forbid")
+    
+    # An explicit null is rejected; leaving the field out keeps the current name
+    name: str = None
+    description: Optional[str] = None
+
+# Outbound messages buffered per client before it is considered too slow
+CLIENT_QUEUE_SIZE = 256
+
+# Window (seconds) in which joins/leaves of a document share one awareness broadcast
+AWARENESS_DELAY = 0.05
+
+# Pause (seconds) before retrying Redis after a pub/sub error
+REDIS_RETRY_DELAY = 1.0
+
+# Broadcasts buffered for publishing to Redis; beyond this they are dropped
+OUTBOX_SIZE = 10000
+
+# How often (seconds) a worker refreshes its heartbeat, and how long the
+# heartbeat lives; a worker silent for WORKER_TTL has its presence cleared
+WORKER_HEARTBEAT = 10
+WORKER_TTL = 30
+
+# Identifies this process's entries in the shared presence sets
+WORKER_ID = uuid.uuid4().hex
+
+@dataclass
+class ClientConn:
+    """A collaboration client with its own outbound queue and writer task"""
+    ws: WebSocket
+    out_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE))
+    writer_task: Optional[asyncio.Task] = None
+
+# Redis keys shared by all workers
+ROOMS_KEY = "rooms"
+WORKERS_KEY = "workers"
+
+def collab_channel(room_id: str, document_id: str) -> str:
+    return f"collab:{room_id}:{document_id}"
+
+def presence_key(room_id: str, document_id: Optional[str] = None) -> str:
+    if document_id is None:
+        return f"presence:{room_id}"
+    return f"presence:{room_id}:{document_id}"
+
+def worker_key(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+def worker_presence_key(worker_id: str) -> str:
+    return f"worker-presence:{worker_id}"
+
+def presence_entries(worker_id: str, room_id: str, user_id: str, document_id: str):
+    """
+    The (set, member) pairs recording one client's presence. Members carry the
+    worker ID so a stopped worker's clients can be found and cleared, and the
+    worker keeps its own list of them for that purpose.
+    """
+    return (
+        (presence_key(room_id), f"{worker_id}:{document_id}:{user_id}"),
+        (presence_key(room_id, document_id), f"{worker_id}:{user_id}"),
+        (worker_presence_key(worker_id), orjson.dumps([room_id, document_id, user_id])),
+    )
+
+def pack_frame(payload: Payload, exclude: Optional[str]) -> bytes:
+    """Frame a payload for pub/sub: a JSON header line, then the payload itself"""
+    binary = isinstance(payload, bytes)
+    header = orjson.dumps({"exclude": exclude, "binary": binary})
+    return b"".join((header, b"\n", payload if binary else payload.encode()))
+
+def unpack_frame(data: bytes):
+    """
+    Split a pub/sub frame. The header and text payloads are read through a
+    memoryview; binary payloads are sliced out once and then shared by every
+    recipient's queue (ASGI needs real bytes for binary frames).
+    """
+    split = data.index(b"\n")
+    view = memoryview(data)
+    header = orjson.loads(view[:split])
+    if header["binary"]:
+        return data[split + 1:], header["exclude"]
+    return str(view[split + 1:], "utf-8"), header["exclude"]
+
+class RedisBus:
+    """
+    Redis pub/sub shared by the collaboration and chat managers. Publishes go
+    through a bounded outbox drained by one pipelined publisher; a single
+    listener hands each message to the handler subscribed to its channel.
+    """
+    def __init__(self, client):
+        self.redis = client
+        self.pubsub = client.pubsub()
+        # Map of channel to the callback that delivers its messages locally
+        self._handlers: Dict[str, Callable[[bytes], None]] = {}
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self._publisher_task = asyncio.create_task(self._publisher())
+        self._listener_task: Optional[asyncio.Task] = None
+    
+    async def close(self):
+        for task in (self._publisher_task, self._listener_task):
+            if task is not None:
+                task.cancel()
+        await self.pubsub.aclose()
+    
+    def publish(self, channel: str, data: bytes) -> bool:
+        """Queue a message for every worker; False if the outbox is full. Never waits on the network."""
+        try:
+            self._outbox.put_nowait((channel, data))
+            return True
+        except asyncio.QueueFull:
+            # Redis is down or too slow; drop rather than buffer without bound
+            return False
+    
+    async def subscribe(self, channel: str, handler: Callable[[bytes], None]):
+        if channel in self._handlers:
+            return
+        self._handlers[channel] = handler
+        await self.pubsub.subscribe(channel)
+        # listen() returns once nothing is subscribed, so restart it as needed
+        if self._listener_task is None or self._listener_task.done():
+            self._listener_task = asyncio.create_task(self._listener())
+    
+    async def unsubscribe(self, channel: str):
+        if self._handlers.pop(channel, None) is not None:
+            await self.pubsub.unsubscribe(channel)
+    
+    async def _listener(self):
+        """
+        Hand messages published by any worker to their handlers.
+        On a connection error, reconnect and resubscribe rather than stopping.
+        """
+        reconnecting = False
+        while True:
+            try:
+                if reconnecting:
+                    await self._resubscribe()
+                    reconnecting = False
+                async for message in self.pubsub.listen():
+                    if message["type"] == "message":
+                        self._on_message(message)
+                # listen() ends once nothing is subscribed
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Redis pub/sub listener failed, reconnecting: %s", e)
+                reconnecting = True
+                await asyncio.sleep(REDIS_RETRY_DELAY)
+    
+    def _on_message(self, message: dict):
+        """Deliver one pub/sub message, skipping it if it can't be handled"""
+        try:
+            handler = self._handlers.get(message["channel"].decode())
+            if handler is not None:
+                handler(message["data"])
+        except Exception as e:
+            logger.error("Skipping bad pub/sub message on %s: %s", message.get("channel"), e)
+    
+    async def _resubscribe(self):
+        """Replace a broken pub/sub connection and subscribe to every channel again"""
+        broken, self.pubsub = self.pubsub, self.redis.pubsub()
+        try:
+            await broken.aclose()
+        except Exception:
+            pass
+        if self._handlers:
+            await self.pubsub.subscribe(*self._handlers)
+    
+    async def _publisher(self):
+        """Publish queued messages in order, pipelining whatever has piled up"""
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            pipe = self.redis.pipeline(transaction=False)
+            for channel, data in batch:
+                pipe.publish(channel, data)
+            try:
+                await pipe.execute()
+            except Exception as e:
+                logger.error("Error publishing %d messages to Redis: %s", len(batch), e)
+                # Back off so a Redis outage fills the outbox instead of spinning
+                await asyncio.sleep(REDIS_RETRY_DELAY)
+
 # WebSocket connection manager
 class ConnectionManager:
+    """
+    Tracks the collaboration clients connected to this process. When Redis is
+    configured, broadcasts and presence go through Redis so that clients on
+    other workers see them too; otherwise everything stays in-process.
+    """
     def __init__(self):
-        # Structure: {room_id: {document_id: {client_id: websocket}}}
-        self.active_connections: Dict[str, Dict[str, Dict[str, WebSocket]]] = {}
-        
+        # Structure: {(room_id, document_id): {client_id: ClientConn}}
+        self.doc_clients: Dict[Tuple[str, str], Dict[str, ClientConn]] = {}
+        # Documents with connected clients, per room
+        self.room_docs: Dict[str, Set[str]] = defaultdict(set)
+        # Connected clients per room, across all its documents
+        self.room_user_count: Dict[str, int] = defaultdict(int)
+        # Documents with an awareness broadcast already scheduled
+        self.pending_awareness: Set[Tuple[str, str]] = set()
+        # Keep references to fire-and-forget tasks (e.g. closing slow clients)
+        self._tasks: Set[asyncio.Task] = set()
+        # Redis state, set up by use_redis()
+        self.bus: Optional[RedisBus] = None
+        self.redis = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+    
+    def use_redis(self, bus: RedisBus):
+        """Route broadcasts and presence through Redis"""
+        self.bus = bus
+        self.redis = bus.redis
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+    
+    async def close_redis(self):
+        """Stop the heartbeat and remove whatever presence this worker still holds"""
+        self._heartbeat_task.cancel()
+        await self._clear_presence(WORKER_ID)
+    
     async def connect(self, websocket: WebSocket, room_id: str, user_id: str, document_id: str):
         await websocket.accept()
         
-        # Initialize nested dictionaries if they don't exist
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = {}
+        key = (room_id, document_id)
+        clients = self.doc_clients.get(key)
+        if clients is None:
+            clients = self.doc_clients[key] = {}
+            self.room_docs[room_id].add(document_id)
+        
+        # Replace any previous connection for the same user, closing its socket
+        previous = clients.get(user_id)
+        if previous is not None:
+            previous.writer_task.cancel()
+            self._spawn(previous.ws.close(code=status.WS_1000_NORMAL_CLOSURE))
+        else:
+            self.room_user_count[room_id] += 1
         
-        if document_id not in self.active_connections[room_id]:
-            self.active_connections[room_id][document_id] = {}
+        # Store the connection and start its writer
+        conn = ClientConn(ws=websocket)
+        conn.writer_task = asyncio.create_task(self._writer(conn, room_id, user_id, document_id))
+        clients[user_id] = conn
         
-        # Store the connection
-        self.active_connections[room_id][document_id][user_id] = websocket
+        if self.redis is not None:
+            await self.bus.subscribe(collab_channel(room_id, document_id), partial(self._on_published, key))
+            pipe = self.redis.pipeline(transaction=False)
+            for name, member in presence_entries(WORKER_ID, room_id, user_id, document_id):
+                pipe.sadd(name, member)
+            await pipe.execute()
         
-        logger.info(f"WebSocket connected: room={room_id}, user={user_id}, document={document_id}")
+        logger.debug("WebSocket connected: room=%s, user=%s, document=%s", room_id, user_id, document_id)
         
         # Send awareness update to all clients in the room
-        await self.broadcast_awareness(room_id, document_id)
+        self.schedule_awareness(room_id, document_id)
     
-    def disconnect(self, room_id: str, user_id: str, document_id: str):
-        if (room_id in self.active_connections and 
-            document_id in self.active_connections[room_id] and 
-            user_id in self.active_connections[room_id][document_id]):
-            
-            # Remove the connection
-            del self.active_connections[room_id][document_id][user_id]
-            
-            # Clean up empty dictionaries
-            if not self.active_connections[room_id][document_id]:
-                del self.active_connections[room_id][document_id]
+    async def disconnect(self, websocket: WebSocket, room_id: str, user_id: str, document_id: str):
+        if not self._remove(websocket, room_id, user_id, document_id):
+            return False
+        if self.redis is not None:
+            await self._forget(room_id, user_id, document_id)
+        return True
+    
+    def _remove(self, websocket: WebSocket, room_id: str, user_id: str, document_id: str):
+        """
+        Remove a client from this process's bookkeeping, unless the user's
+        entry now belongs to a newer connection
+        """
+        key = (room_id, document_id)
+        clients = self.doc_clients.get(key)
+        conn = clients.get(user_id) if clients else None
+        if conn is None or conn.ws is not websocket:
+            return False
+        
+        # Remove the connection and stop its writer
+        del clients[user_id]
+        conn.writer_task.cancel()
+        
+        # Clean up empty entries
+        if not clients:
+            del self.doc_clients[key]
+            docs = self.room_docs[room_id]
+            docs.discard(document_id)
+            if not docs:
+                del self.room_docs[room_id]
+        
+        remaining = self.room_user_count[room_id] - 1
+        if remaining:
+            self.room_user_count[room_id] = remaining
+        else:
+            del self.room_user_count[room_id]
             
-            if not self.active_connections[room_id]:
-                del self.active_connections[room_id]
+        logger.debug("WebSocket disconnected: room=%s, user=%s, document=%s", room_id, user_id, document_id)
+        return True
+    
+    async def _forget(self, room_id: str, user_id: str, document_id: str):
+        """Remove a client's shared presence, and stop listening to the document if it was the last local client"""
+        pipe = self.redis.pipeline(transaction=False)
+        for name, member in presence_entries(WORKER_ID, room_id, user_id, document_id):
+            pipe.srem(name, member)
+        await pipe.execute()
+        if (room_id, document_id) not in self.doc_clients:
+            await self.bus.unsubscribe(collab_channel(room_id, document_id))
+    
+    def _on_published(self, key: Tuple[str, str], data: bytes):
+        """Deliver a broadcast published by any worker to this process's clients"""
+        payload, exclude = unpack_frame(data)
+        self._deliver(key, payload, exclude)
+    
+    async def _heartbeat(self):
+        """
+        Keep this worker registered, and clear the presence left behind by
+        workers whose heartbeat has expired (e.g. after a crash)
+        """
+        while True:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.set(worker_key(WORKER_ID), 1, ex=WORKER_TTL)
+                pipe.sadd(WORKERS_KEY, WORKER_ID)
+                pipe.smembers(WORKERS_KEY)
+                *_, workers = await pipe.execute()
                 
-            logger.info(f"WebSocket disconnected: room={room_id}, user={user_id}, document={document_id}")
-            return True
-        return False
+                others = [worker.decode() for worker in workers if worker.decode() != WORKER_ID]
+                if others:
+                    pipe = self.redis.pipeline(transaction=False)
+                    for worker_id in others:
+                        pipe.exists(worker_key(worker_id))
+                    for worker_id, alive in zip(others, await pipe.execute()):
+                        if not alive:
+                            logger.info("Clearing presence of stopped worker %s", worker_id)
+                            for key in await self._clear_presence(worker_id):
+                                self.schedule_awareness(*key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Redis presence heartbeat failed: %s", e)
+            await asyncio.sleep(WORKER_HEARTBEAT)
+    
+    async def _clear_presence(self, worker_id: str) -> Set[Tuple[str, str]]:
+        """Remove every presence entry recorded by a worker; returns the documents affected"""
+        entries = await self.redis.smembers(worker_presence_key(worker_id))
+        docs = set()
+        pipe = self.redis.pipeline(transaction=False)
+        for entry in entries:
+            room_id, document_id, user_id = orjson.loads(entry)
+            for name, member in presence_entries(worker_id, room_id, user_id, document_id):
+                pipe.srem(name, member)
+            docs.add((room_id, document_id))
+        pipe.delete(worker_presence_key(worker_id), worker_key(worker_id))
+        pipe.srem(WORKERS_KEY, worker_id)
+        await pipe.execute()
+        return docs
+    
+    def schedule_awareness(self, room_id: str, document_id: str):
+        """
+        Broadcast awareness after AWARENESS_DELAY, so a burst of joins/leaves
+        costs one broadcast instead of one each
+        """
+        key = (room_id, document_id)
+        if key not in self.pending_awareness:
+            self.pending_awareness.add(key)
+            asyncio.get_running_loop().call_later(AWARENESS_DELAY, self._flush_awareness, key)
+    
+    def _flush_awareness(self, key: Tuple[str, str]):
+        self.pending_awareness.discard(key)
+        self._spawn(self.broadcast_awareness(*key))
     
     async def broadcast_awareness(self, room_id: str, document_id: str):
         """Send awareness update (who's online) to all clients in the document"""
-        if room_id in self.active_connections and document_id in self.active_connections[room_id]:
-            users = list(self.active_connections[room_id][document_id].keys())
+        if self.redis is not None:
+            # Members are "worker:user"; a user connected through two workers is listed once
+            members = await self.redis.smembers(presence_key(room_id, document_id))
+            users = list(dict.fromkeys(member.decode().split(":", 1)[1] for member in members))
+        else:
+            users = list(self.doc_clients.get((room_id, document_id), ()))
+        if users:
             awareness_message = {
                 "type": "awareness",
                 "users": users,
@@ -83,74 +453,200 @@ class ConnectionManager:
         """
         Broadcast a message to all connected clients in a document
         """
-        if room_id in self.active_connections and document_id in self.active_connections[room_id]:
-            # Convert message to JSON if it's not a string already
-            if not isinstance(message, str):
-                message = json.dumps(message)
-                
-            # Send to all connected clients
-            for user_id, connection in self.active_connections[room_id][document_id].items():
-                try:
-                    await connection.send_text(message)
-                except Exception as e:
-                    logger.error(f"Error sending message to {user_id}: {e}")
+        self._fanout(room_id, document_id, message)
     
     async def broadcast_update(self, room_id: str, document_id: str, sender_id: str, update: Any):
         """
-        Broadcast an update to all connected clients except the sender
+        Broadcast an update (JSON, text, or binary Y.js) to all connected clients except the sender
         """
-        if room_id in self.active_connections and document_id in self.active_connections[room_id]:
-            # Convert update to JSON if it's not a string already
-            if not isinstance(update, str):
-                update = json.dumps(update)
-                
-            # Send to all connected clients except sender
-            for user_id, connection in self.active_connections[room_id][document_id].items():
-                if user_id != sender_id:  # Don't send back to the sender
-                    try:
-                        await connection.send_text(update)
-                    except Exception as e:
-                        logger.error(f"Error sending update to {user_id}: {e}")
-    
-    def get_active_users(self, room_id: str, document_id: str = None) -> int:
+        self._fanout(room_id, document_id, update, exclude=sender_id)
+    
+    def send_personal(self, room_id: str, document_id: str, user_id: str, message: Any):
+        """
+        Queue a message for a single client, behind anything already queued for it
+        """
+        conn = self.doc_clients.get((room_id, document_id), {}).get(user_id)
+        if conn is not None:
+            self._offer(room_id, document_id, user_id, conn, encode_message(message))
+    
+    def _fanout(self, room_id: str, document_id: str, message: Any, exclude: Optional[str] = None):
+        """
+        Send a message to every client in a document, on every worker when Redis
+        is configured. Never waits on the network.
+        """
+        # Encode once for all recipients
+        payload = encode_message(message)
+        if self.bus is not None:
+            if not self.bus.publish(collab_channel(room_id, document_id), pack_frame(payload, exclude)):
+                logger.warning("Redis outbox full, dropping broadcast to %s/%s", room_id, document_id)
+        else:
+            self._deliver((room_id, document_id), payload, exclude)
+    
+    def _deliver(self, key: Tuple[str, str], payload: Payload, exclude: Optional[str]):
+        """Queue a payload for this process's clients in a document"""
+        clients = self.doc_clients.get(key)
+        if clients:
+            room_id, document_id = key
+            # Snapshot the clients, since dropping a slow one mutates the dict
+            for user_id, conn in list(clients.items()):
+                if user_id != exclude:
+                    self._offer(room_id, document_id, user_id, conn, payload)
+    
+    def _offer(self, room_id: str, document_id: str, user_id: str, conn: ClientConn, payload: Payload):
+        """Put a payload on a client's queue, disconnecting the client if it is too far behind"""
+        try:
+            conn.out_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning("Dropping slow client %s: outbound queue full", user_id)
+            self._drop(room_id, user_id, document_id, conn)
+            self._spawn(conn.ws.close(code=status.WS_1013_TRY_AGAIN_LATER))
+    
+    async def _writer(self, conn: ClientConn, room_id: str, user_id: str, document_id: str):
+        """Drain a client's outbound queue onto its socket"""
+        try:
+            while True:
+                message = await conn.out_queue.get()
+                if isinstance(message, str):
+                    await conn.ws.send_text(message)
+                else:
+                    await conn.ws.send_bytes(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error sending message to %s: %s", user_id, e)
+            self._drop(room_id, user_id, document_id, conn)
+    
+    def _drop(self, room_id: str, user_id: str, document_id: str, conn: ClientConn):
+        """Disconnect a client, unless it has already been replaced by a newer connection"""
+        if self._remove(conn.ws, room_id, user_id, document_id) and self.redis is not None:
+            self._spawn(self._forget(room_id, user_id, document_id))
+    
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def get_active_users(self, room_id: str, document_id: str = None) -> int:
         """
         Get the number of active users in a room or document
         """
-        if room_id not in self.active_connections:
-            return 0
-            
+        if self.redis is not None:
+            return await self.redis.scard(presence_key(room_id, document_id))
         if document_id is None:
             # Count all users across all documents in the room
-            count = 0
-            for doc_id in self.active_connections[room_id]:
-                count += len(self.active_connections[room_id][doc_id])
-            return count
-        elif document_id in self.active_connections[room_id]:
-            # Count users in specific document
-            return len(self.active_connections[room_id][document_id])
-        return 0
+            return self.room_user_count.get(room_id, 0)
+        # Count users in specific document
+        return len(self.doc_clients.get((room_id, document_id), ()))
+    
+    async def get_active_users_many(self, room_ids: List[str]) -> List[int]:
+        """
+        Get the number of active users in each room, in one Redis round trip
+        """
+        if self.redis is None:
+            return [self.room_user_count.get(room_id, 0) for room_id in room_ids]
+        pipe = self.redis.pipeline(transaction=False)
+        for room_id in room_ids:
+            pipe.scard(presence_key(room_id))
+        return await pipe.execute()
 
 # Create connection manager instance
 manager = ConnectionManager()
 
-# Mock database (in-memory)
-rooms_db: Dict[str, Room] = {}
+class RoomStore:
+    """
+    Room storage: an in-process dict, or the Redis hash ROOMS_KEY when Redis
+    is configured so that every worker sees the same rooms.
+    """
+    def __init__(self):
+        self.local: Dict[str, Room] = {}
+        self.redis = None
+    
+    async def get(self, room_id: str) -> Optional[Room]:
+        if self.redis is None:
+            return self.local.get(room_id)
+        raw = await self.redis.hget(ROOMS_KEY, room_id)
+        return Room.model_validate_json(raw) if raw is not None else None
+    
+    async def save(self, room: Room):
+        if self.redis is None:
+            self.local[room.id] = room
+        else:
+            await self.redis.hset(ROOMS_KEY, room.id, room.model_dump_json())
+    
+    async def delete(self, room_id: str) -> Optional[Room]:
+        if self.redis is None:
+            return self.local.pop(room_id, None)
+        room = await self.get(room_id)
+        if room is not None:
+            await self.redis.hdel(ROOMS_KEY, room_id)
+        return room
+    
+    async def all(self) -> List[Room]:
+        if self.redis is None:
+            return list(self.local.values())
+        return [Room.model_validate_json(raw) for raw in await self.redis.hvals(ROOMS_KEY)]
+    
+    async def first(self, limit: int) -> List[Room]:
+        """Up to `limit` rooms, without loading the rest"""
+        if self.redis is None:
+            return list(islice(self.local.values(), limit))
+        rooms = []
+        async for _, raw in self.redis.hscan_iter(ROOMS_KEY, count=limit):
+            rooms.append(Room.model_validate_json(raw))
+            if len(rooms) == limit:
+                break
+        return rooms
+    
+    async def count(self) -> int:
+        if self.redis is None:
+            return len(self.local)
+        return await self.redis.hlen(ROOMS_KEY)
+
+# Room database: in-memory, or shared through Redis
+rooms_db = RoomStore()
+
+# --- Redis ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Connect to Redis on startup when REDIS_URL is set, and close it on shutdown"""
+    client = None
+    if REDIS_URL:
+        if aioredis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        client = aioredis.from_url(REDIS_URL)
+        bus = RedisBus(client)
+        manager.use_redis(bus)
+        chat_manager.use_redis(bus)
+        rooms_db.redis = client
+        logger.info("Sharing rooms, collaboration and chat through Redis")
+    yield
+    if client is not None:
+        chat_manager.close_redis()
+        await manager.close_redis()
+        await bus.close()
+        await client.aclose()
 
 # Initialize the FastAPI app
 app = FastAPI(
     title="Mentora Collaborative Backend",
     description="API for real-time collaboration features.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # --- CORS Configuration ---
-origins = [
-    "http://localhost:5173",
-    "http://127.0.0.1:5173",
-    "http://localhost:3000",
-    "http://127.0.0.1:3000",
-    "*",  # Allow all origins for development - remove in production!
-]
+# Extra allowed origins, comma-separated (e.g. the deployed frontend)
+origins = {origin.strip() for origin in os.getenv("CORS_ORIGINS", "").split(",") if origin.strip()}
+
+# Local dev servers are only allowed in development (the default)
+if os.getenv("ENV", "dev") == "dev":
+    origins |= {
+        "http://localhost:5173",
+        "http://127.0.0.1:5173",
+        "http://localhost:3000",
+        "http://127.0.0.1:3000",
+    }
 
 app.add_middleware(
     CORSMiddleware,
@@ -160,51 +656,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Request Logging Middleware ---
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info(f"Request path: {request.url.path}")
-    try:
-        response = await call_next(request)
-        logger.info(f"Response status code: {response.status_code}")
-        return response
-    except Exception as e:
-        logger.error(f"Request failed: {e}")
-        raise
-
 # --- API Endpoints ---
 
+# Health check bodies never change, so encode them once
+ROOT_BODY = orjson.dumps({"message": "Welcome to the Mentora Collaborative Backend!"})
+STATUS_BODY = orjson.dumps({"status": "ok", "message": "Backend is operational"})
+
 @app.get("/")
 async def read_root():
     """
     Root endpoint to check if the backend is running.
     """
-    return {"message": "Welcome to the Mentora Collaborative Backend!"}
+    return Response(content=ROOT_BODY, media_type="application/json")
 
 @app.get("/api/v1/status")
 async def get_status():
     """
     A simple status check endpoint.
     """
-    return {"status": "ok", "message": "Backend is operational"}
+    return Response(content=STATUS_BODY, media_type="application/json")
 
 # --- Room Management Endpoints ---
 
 @app.get("/api/v1/rooms")
-async def get_rooms():
+async def get_rooms() -> List[Room]:
     """
     Get all available rooms.
     """
-    logger.info(f"Returning all rooms. Current count: {len(rooms_db)}")
-    return list(rooms_db.values())
+    rooms = await rooms_db.all()
+    counts = await manager.get_active_users_many([room.id for room in rooms])
+    for room, count in zip(rooms, counts):
+        room.active_users = count
+    logger.debug("Returning all rooms. Current count: %d", len(rooms))
+    return rooms
 
 @app.post("/api/v1/rooms", status_code=201)
-async def create_room(room_data: RoomCreate):
+async def create_room(room_data: RoomCreate) -> Room:
     """
     Create a new collaboration room.
     """
     # Generate a timestamp-based ID
-    room_id = str(int(datetime.now().timestamp() * 1000))
+    room_id = next_id()
     
     # Create new room instance
     new_room = Room(
@@ -216,21 +708,22 @@ async def create_room(room_data: RoomCreate):
     )
     
     # Save to "database"
-    rooms_db[room_id] = new_room
-    logger.info(f"Created new room with ID: {room_id}")
+    await rooms_db.save(new_room)
+    logger.info("Created new room with ID: %s", room_id)
     
     return new_room
 
 @app.get("/api/v1/rooms/{room_id}")
-async def get_room(room_id: str = Path(..., description="The ID of the room to retrieve")):
+async def get_room(room_id: str = Path(..., description="The ID of the room to retrieve")) -> Room:
     """
     Get details for a specific room.
     """
-    logger.info(f"Fetching room with ID: {room_id}")
+    logger.debug("Fetching room with ID: %s", room_id)
     
     # Check if this is a new room ID we don't have yet
-    if room_id not in rooms_db:
-        logger.warning(f"Room {room_id} not found. Creating a placeholder room.")
+    room = await rooms_db.get(room_id)
+    if room is None:
+        logger.warning("Room %s not found. Creating a placeholder room.", room_id)
         
         # For development purposes, create a room on-the-fly if it doesn't exist
         new_room = Room(
@@ -240,38 +733,35 @@ async def get_room(room_id: str = Path(..., description="The ID of the room to r
             created_at=datetime.now().isoformat(),
             active_users=0
         )
-        rooms_db[room_id] = new_room
+        await rooms_db.save(new_room)
         
         return new_room
     
     # Update active users count from WebSocket connections
-    rooms_db[room_id].active_users = manager.get_active_users(room_id)
+    room.active_users = await manager.get_active_users(room_id)
     
-    logger.info(f"Room {room_id} found and returned")
-    return rooms_db[room_id]
+    logger.debug("Room %s found and returned", room_id)
+    return room
 
 @app.put("/api/v1/rooms/{room_id}")
 async def update_room(
     room_id: str = Path(...), 
-    room_data: dict = Body(...)
-):
+    room_data: RoomUpdate = Body(...)
+) -> Room:
     """
     Update a specific room's details.
     """
-    if room_id not in rooms_db:
-        raise HTTPException(status_code=404, detail="Room not found")
-    
     # Get the existing room
-    room = rooms_db[room_id]
+    room = await rooms_db.get(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found")
     
     # Update fields that are present in the request
-    for key, value in room_data.items():
-        if hasattr(room, key) and key not in ["id", "created_at"]:  # Protect certain fields
-            setattr(room, key, value)
+    room = room.model_copy(update=room_data.model_dump(exclude_unset=True))
     
     # Update in "database"
-    rooms_db[room_id] = room
-    logger.info(f"Updated room with ID: {room_id}")
+    await rooms_db.save(room)
+    logger.info("Updated room with ID: %s", room_id)
     
     return room
 
@@ -280,12 +770,11 @@ async def delete_room(room_id: str = Path(..., description="The ID of the room t
     """
     Delete a specific room.
     """
-    if room_id not in rooms_db:
-        raise HTTPException(status_code=404, detail="Room not found")
-    
     # Remove room from "database"
-    deleted_room = rooms_db.pop(room_id)
-    logger.info(f"Deleted room with ID: {room_id}")
+    deleted_room = await rooms_db.delete(room_id)
+    if deleted_room is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    logger.info("Deleted room with ID: %s", room_id)
     
     return {"message": f"Room '{deleted_room.name}' deleted successfully"}
 
@@ -306,8 +795,8 @@ async def websocket_endpoint(
         # Accept the connection
         await manager.connect(websocket, room_id, user_id, document_id)
         
-        # Make sure the room exists
-        if room_id not in rooms_db:
+        # Make sure the room exists (active users are counted when rooms are read)
+        if await rooms_db.get(room_id) is None:
             # Create room on the fly
             new_room = Room(
                 id=room_id,
@@ -316,55 +805,61 @@ async def websocket_endpoint(
                 created_at=datetime.now().isoformat(),
                 active_users=1
             )
-            rooms_db[room_id] = new_room
-        else:
-            # Update active users count
-            rooms_db[room_id].active_users = manager.get_active_users(room_id)
+            await rooms_db.save(new_room)
         
         # Handle WebSocket messages
-        try:
-            while True:
-                # Wait for messages from the client
-                data = await websocket.receive_text()
-                
-                try:
-                    # Try to parse as JSON
-                    message = json.loads(data)
-                    
-                    # Handle different message types
-                    if isinstance(message, dict) and "type" in message:
-                        if message["type"] == "sync":
-                            # This is a Y.js sync message - broadcast to others
-                            await manager.broadcast_update(room_id, document_id, user_id, message)
-                        elif message["type"] == "awareness":
-                            # This is an awareness update - broadcast to all
-                            await manager.broadcast(room_id, document_id, message)
-                        elif message["type"] == "ping":
-                            # Ping message - respond with pong
-                            await websocket.send_text(json.dumps({"type": "pong"}))
-                    else:
-                        # Default: treat as Y.js update and broadcast
-                        await manager.broadcast_update(room_id, document_id, user_id, data)
-                        
-                except json.JSONDecodeError:
-                    # Not JSON, treat as binary update and broadcast as is
-                    await manager.broadcast_update(room_id, document_id, user_id, data)
-                    
-        except WebSocketDisconnect:
-            # Handle client disconnect
-            manager.disconnect(room_id, user_id, document_id)
+        while True:
+            # Wait for messages from the client
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", status.WS_1000_NORMAL_CLOSURE))
+            
+            update = received.get("bytes")
+            if update is not None:
+                # Binary Y.js update - broadcast as is, without any decoding
+                await manager.broadcast_update(room_id, document_id, user_id, update)
+                continue
             
-            # Update room active users count
-            if room_id in rooms_db:
-                rooms_db[room_id].active_users = manager.get_active_users(room_id)
+            data = received.get("text") or ""
+            if data[:1] not in ("{", "["):
+                # Can't be JSON, treat as a Y.js update and broadcast as is
+                await manager.broadcast_update(room_id, document_id, user_id, data)
+                continue
             
-            # Notify other clients about the disconnect
-            await manager.broadcast_awareness(room_id, document_id)
+            try:
+                message = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # Not JSON after all, treat as a Y.js update and broadcast as is
+                await manager.broadcast_update(room_id, document_id, user_id, data)
+                continue
             
+            # Handle different message types
+            if isinstance(message, dict) and "type" in message:
+                if message["type"] == "sync":
+                    # This is a Y.js sync message - broadcast to others
+                    await manager.broadcast_update(room_id, document_id, user_id, message)
+                elif message["type"] == "awareness":
+                    # This is an awareness update - broadcast to all
+                    await manager.broadcast(room_id, document_id, message)
+                elif message["type"] == "ping":
+                    # Ping message - respond with pong through the client's queue
+                    manager.send_personal(room_id, document_id, user_id, {"type": "pong"})
+            else:
+                # Default: treat as Y.js update and broadcast
+                await manager.broadcast_update(room_id, document_id, user_id, data)
+            
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        logger.error(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e)
         if websocket.client_state != WebSocketState.DISCONNECTED:
             await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        # Handle client disconnect
+        await manager.disconnect(websocket, room_id, user_id, document_id)
+        
+        # Notify other clients about the disconnect
+        manager.schedule_awareness(room_id, document_id)
 
 # --- User Room Interaction ---
 class ChatMessage(BaseModel):
@@ -374,112 +869,195 @@ class ChatMessage(BaseModel):
     timestamp: str
     id: Optional[str] = None
 
+def chat_channel(room_id: str) -> str:
+    return f"chat:{room_id}"
+
+def chat_history_key(room_id: str) -> str:
+    return f"chat-history:{room_id}"
+
+# Chat messages received from Redis and waiting to be sent to local sockets
+CHAT_INBOX_SIZE = 10000
+
 # Chat connection manager
 class ChatConnectionManager:
+    """
+    Tracks the chat sockets connected to this process. When Redis is
+    configured, messages are published to every worker and history is kept
+    in a capped Redis list; otherwise both stay in-process.
+    """
     def __init__(self):
-        # Map of room_id to list of WebSocket connections
-        self.active_chats: Dict[str, List[WebSocket]] = {}
-        # Map of room_id to list of recent messages (keep last 50 messages)
-        self.message_history: Dict[str, List[ChatMessage]] = {}
+        # Map of room_id to set of WebSocket connections
+        self.active_chats: Dict[str, Set[WebSocket]] = {}
         # Maximum number of messages to keep in history per room
         self.max_history = 50
+        # Map of room_id to recent messages, each stored as its encoded JSON;
+        # the deque drops the oldest beyond max_history
+        self.message_history: Dict[str, Deque[str]] = defaultdict(lambda: deque(maxlen=self.max_history))
+        # Map of room_id to the encoded history message, shared by joiners until the next message
+        self._history_cache: Dict[str, str] = {}
+        # Redis state, set up by use_redis()
+        self.bus: Optional[RedisBus] = None
+        self._inbox: Optional[asyncio.Queue] = None
+        self._delivery_task: Optional[asyncio.Task] = None
+    
+    def use_redis(self, bus: RedisBus):
+        """Route messages and history through Redis"""
+        self.bus = bus
+        self._inbox = asyncio.Queue(maxsize=CHAT_INBOX_SIZE)
+        self._delivery_task = asyncio.create_task(self._deliverer())
+    
+    def close_redis(self):
+        if self._delivery_task is not None:
+            self._delivery_task.cancel()
     
     async def connect(self, websocket: WebSocket, room_id: str):
         await websocket.accept()
         
         # Initialize the room if it doesn't exist
-        if room_id not in self.active_chats:
-            self.active_chats[room_id] = []
+        connections = self.active_chats.get(room_id)
+        if connections is None:
+            connections = self.active_chats[room_id] = set()
+            if self.bus is not None:
+                await self.bus.subscribe(chat_channel(room_id), partial(self._on_published, room_id))
         
         # Add the connection to the room
-        self.active_chats[room_id].append(websocket)
-        
-        # Initialize message history for the room if it doesn't exist
-        if room_id not in self.message_history:
-            self.message_history[room_id] = []
+        connections.add(websocket)
         
-        logger.info(f"Chat WebSocket connected for room: {room_id}, total connections: {len(self.active_chats[room_id])}")
+        logger.debug("Chat WebSocket connected for room: %s, total connections: %d", room_id, len(connections))
         
         # Send message history to the new connection
         await self.send_history(websocket, room_id)
     
-    def disconnect(self, websocket: WebSocket, room_id: str):
+    async def disconnect(self, websocket: WebSocket, room_id: str):
         # Remove the connection from the room
-        if room_id in self.active_chats and websocket in self.active_chats[room_id]:
-            self.active_chats[room_id].remove(websocket)
-            logger.info(f"Chat WebSocket disconnected from room: {room_id}, remaining: {len(self.active_chats[room_id])}")
+        connections = self.active_chats.get(room_id)
+        if connections and websocket in connections:
+            connections.discard(websocket)
+            logger.debug("Chat WebSocket disconnected from room: %s, remaining: %d", room_id, len(connections))
             
             # Clean up empty rooms
-            if not self.active_chats[room_id]:
+            if not connections:
                 del self.active_chats[room_id]
-                logger.info(f"Removed empty chat room: {room_id}")
+                logger.debug("Removed empty chat room: %s", room_id)
+                if self.bus is not None:
+                    await self.bus.unsubscribe(chat_channel(room_id))
     
     async def broadcast(self, room_id: str, message: dict):
-        """Broadcast a message to all connections in a room"""
-        if room_id in self.active_chats:
-            # Store message in history
-            if message.get("type") == "message" and "message" in message:
-                msg_data = message["message"]
-                # Generate ID if not present
-                if "id" not in msg_data:
-                    msg_data["id"] = str(int(datetime.now().timestamp() * 1000))
-                
-                # Create and store the message
-                chat_message = ChatMessage(**msg_data)
-                self.add_to_history(room_id, chat_message)
-            
-            # Serialize message to JSON
-            message_json = json.dumps(message)
-            
-            # Send to all connections in the room
-            disconnected = []
-            for connection in self.active_chats[room_id]:
-                try:
-                    await connection.send_text(message_json)
-                except Exception as e:
-                    logger.error(f"Error sending message to connection in room {room_id}: {e}")
-                    disconnected.append(connection)
+        """Broadcast a message to all connections in a room, on every worker when Redis is configured"""
+        if room_id not in self.active_chats:
+            return
+        
+        # Store message in history
+        chat_message = None
+        if message.get("type") == "message" and "message" in message:
+            msg_data = message["message"]
+            # Generate ID if not present
+            if "id" not in msg_data:
+                msg_data["id"] = next_id()
             
-            # Clean up disconnected connections
-            for connection in disconnected:
-                self.active_chats[room_id].remove(connection)
+            # Create the message
+            chat_message = ChatMessage.model_validate(msg_data)
+        
+        # Serialize message once for all recipients
+        message_json = encode_message(message)
+        
+        if self.bus is None:
+            if chat_message is not None:
+                self.add_to_history(room_id, chat_message)
+            await self._send_all(room_id, message_json)
+            return
+        
+        if chat_message is not None:
+            # Append and cap in one round trip
+            key = chat_history_key(room_id)
+            pipe = self.bus.redis.pipeline(transaction=False)
+            pipe.rpush(key, chat_message.model_dump_json())
+            pipe.ltrim(key, -self.max_history, -1)
+            await pipe.execute()
+        if not self.bus.publish(chat_channel(room_id), message_json.encode()):
+            logger.warning("Redis outbox full, dropping chat message to %s", room_id)
     
-    def add_to_history(self, room_id: str, message: ChatMessage):
-        """Add a message to the room's history"""
-        if room_id not in self.message_history:
-            self.message_history[room_id] = []
+    def _on_published(self, room_id: str, data: bytes):
+        """Queue a message published by any worker for this process's sockets"""
+        try:
+            self._inbox.put_nowait((room_id, data.decode()))
+        except asyncio.QueueFull:
+            logger.warning("Chat inbox full, dropping message to %s", room_id)
+    
+    async def _deliverer(self):
+        """Send messages from Redis to local sockets one at a time, keeping their order"""
+        while True:
+            room_id, message_json = await self._inbox.get()
+            try:
+                await self._send_all(room_id, message_json)
+            except Exception as e:
+                logger.error("Error delivering chat message to room %s: %s", room_id, e)
+    
+    async def _send_all(self, room_id: str, message_json: str):
+        """Send an encoded message to this process's connections in a room"""
+        connections = self.active_chats.get(room_id)
+        if not connections:
+            return
         
-        # Add the message
-        self.message_history[room_id].append(message)
+        # Send to all connections in the room (snapshot, since sends yield)
+        disconnected = []
+        for connection in list(connections):
+            try:
+                await connection.send_text(message_json)
+            except Exception as e:
+                logger.error("Error sending message to connection in room %s: %s", room_id, e)
+                disconnected.append(connection)
         
-        # Trim history if needed
-        if len(self.message_history[room_id]) > self.max_history:
-            self.message_history[room_id] = self.message_history[room_id][-self.max_history:]
+        # Clean up disconnected connections, and the room if none are left
+        for connection in disconnected:
+            await self.disconnect(connection, room_id)
+    
+    def add_to_history(self, room_id: str, message: ChatMessage):
+        """Add a message to the room's history, encoded once up front"""
+        self.message_history[room_id].append(message.model_dump_json())
+        self._history_cache.pop(room_id, None)
     
     async def send_history(self, websocket: WebSocket, room_id: str):
         """Send message history to a specific connection"""
-        if room_id in self.message_history and self.message_history[room_id]:
-            try:
-                # Create a message with the history
-                history_message = {
-                    "type": "history",
-                    "messages": [msg.dict() for msg in self.message_history[room_id]]
-                }
-                
-                # Send history
-                await websocket.send_text(json.dumps(history_message))
-            except Exception as e:
-                logger.error(f"Error sending history to connection in room {room_id}: {e}")
+        try:
+            if self.bus is not None:
+                # Shared history, already stored as encoded JSON
+                history = await self.bus.redis.lrange(chat_history_key(room_id), 0, -1)
+                if not history:
+                    return
+                history_json = (b'{"type":"history","messages":[' + b",".join(history) + b"]}").decode()
+            else:
+                history = self.message_history.get(room_id)
+                if not history:
+                    return
+                # Encode the history once per change, not once per joiner
+                history_json = self._history_cache.get(room_id)
+                if history_json is None:
+                    history_json = self._history_cache[room_id] = (
+                        '{"type":"history","messages":[' + ",".join(history) + "]}"
+                    )
+            
+            # Send history
+            await websocket.send_text(history_json)
+        except Exception as e:
+            logger.error("Error sending history to connection in room %s: %s", room_id, e)
+    
+    async def get_message_counts(self, room_ids: List[str]) -> List[int]:
+        """Get the number of messages in history for each room"""
+        if self.bus is None:
+            return [len(self.message_history.get(room_id, ())) for room_id in room_ids]
+        pipe = self.bus.redis.pipeline(transaction=False)
+        for room_id in room_ids:
+            pipe.llen(chat_history_key(room_id))
+        return await pipe.execute()
     
     def get_active_connections(self, room_id: str = None) -> int:
         """Get the number of active connections"""
         if room_id is None:
             # Total connections across all rooms
             return sum(len(connections) for connections in self.active_chats.values())
-        elif room_id in self.active_chats:
-            # Connections in a specific room
-            return len(self.active_chats[room_id])
-        return 0
+        # Connections in a specific room
+        return len(self.active_chats.get(room_id, ()))
 
 # Create chat manager instance
 chat_manager = ChatConnectionManager()
@@ -496,7 +1074,7 @@ async def chat_websocket(websocket: WebSocket, room_id: str):
         await chat_manager.connect(websocket, room_id)
         
         # Make sure the room exists in the room database
-        if room_id not in rooms_db:
+        if await rooms_db.get(room_id) is None:
             # Create room on the fly
             new_room = Room(
                 id=room_id,
@@ -505,37 +1083,36 @@ async def chat_websocket(websocket: WebSocket, room_id: str):
                 created_at=datetime.now().isoformat(),
                 active_users=1
             )
-            rooms_db[room_id] = new_room
+            await rooms_db.save(new_room)
         
         # Handle WebSocket messages
-        try:
-            while True:
-                # Wait for messages from the client
-                data = await websocket.receive_text()
-                
-                try:
-                    # Parse as JSON
-                    message = json.loads(data)
-                    
-                    # Handle message types
-                    if message.get("type") == "message":
-                        # Broadcast message to all clients in the room
-                        await chat_manager.broadcast(room_id, message)
-                    elif message.get("type") == "ping":
-                        # Respond with pong
-                        await websocket.send_text(json.dumps({"type": "pong"}))
-                    
-                except json.JSONDecodeError:
-                    logger.error(f"Invalid JSON received in chat: {data}")
-                
-        except WebSocketDisconnect:
-            # Handle client disconnect
-            chat_manager.disconnect(websocket, room_id)
+        while True:
+            # Wait for messages from the client
+            data = await websocket.receive_text()
+            
+            try:
+                message = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                logger.error("Invalid JSON received in chat: %s", data)
+                continue
+            
+            # Handle message types
+            if message.get("type") == "message":
+                # Broadcast message to all clients in the room
+                await chat_manager.broadcast(room_id, message)
+            elif message.get("type") == "ping":
+                # Respond with pong
+                await websocket.send_text(encode_message({"type": "pong"}))
             
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        logger.error(f"Chat WebSocket error: {e}")
+        logger.error("Chat WebSocket error: %s", e)
         if websocket.client_state != WebSocketState.DISCONNECTED:
             await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        # Handle client disconnect
+        await chat_manager.disconnect(websocket, room_id)
 
 # --- Add debug endpoint for chat ---
 @app.get("/api/v1/debug/chat")
@@ -543,15 +1120,19 @@ async def debug_chat():
     """
     Debug endpoint to view chat stats and connections.
     """
+    # Snapshot the rooms, since counting messages in Redis yields
+    chats = [(room_id, len(connections)) for room_id, connections in chat_manager.active_chats.items()]
+    message_counts = await chat_manager.get_message_counts([room_id for room_id, _ in chats])
+    
     return {
-        "active_rooms": len(chat_manager.active_chats),
-        "total_connections": chat_manager.get_active_connections(),
+        "active_rooms": len(chats),
+        "total_connections": sum(count for _, count in chats),
         "rooms": {
             room_id: {
-                "connections": len(connections),
-                "message_count": len(chat_manager.message_history.get(room_id, []))
+                "connections": connections,
+                "message_count": message_count
             }
-            for room_id, connections in chat_manager.active_chats.items()
+            for (room_id, connections), message_count in zip(chats, message_counts)
         }
     }
 
@@ -560,56 +1141,65 @@ async def join_room(room_id: str = Path(...)):
     """
     Join a specific room (increment active users).
     """
-    if room_id not in rooms_db:
+    room = await rooms_db.get(room_id)
+    if room is None:
         raise HTTPException(status_code=404, detail="Room not found")
     
     # Update active users count from WebSocket connections
-    rooms_db[room_id].active_users = manager.get_active_users(room_id)
-    logger.info(f"User joined room {room_id}. Active users: {rooms_db[room_id].active_users}")
+    room.active_users = await manager.get_active_users(room_id)
+    logger.debug("User joined room %s. Active users: %d", room_id, room.active_users)
     
-    return {"message": "Joined room successfully", "room": rooms_db[room_id]}
+    return {"message": "Joined room successfully", "room": room}
 
 @app.post("/api/v1/rooms/{room_id}/leave")
 async def leave_room(room_id: str = Path(...)):
     """
     Leave a specific room (decrement active users).
     """
-    if room_id not in rooms_db:
+    room = await rooms_db.get(room_id)
+    if room is None:
         raise HTTPException(status_code=404, detail="Room not found")
     
     # Update active users count from WebSocket connections
-    rooms_db[room_id].active_users = manager.get_active_users(room_id)
-    logger.info(f"User left room {room_id}. Active users: {rooms_db[room_id].active_users}")
+    room.active_users = await manager.get_active_users(room_id)
+    logger.debug("User left room %s. Active users: %d", room_id, room.active_users)
     
-    return {"message": "Left room successfully", "room": rooms_db[room_id]}
+    return {"message": "Left room successfully", "room": room}
 
 # --- Debug Endpoints ---
 
+# Maximum number of entries listed by the debug endpoints
+DEBUG_LIST_LIMIT = 100
+
 @app.get("/api/v1/debug/rooms")
 async def debug_rooms():
     """
-    Debug endpoint to view all room data.
+    Debug endpoint to view room data (first DEBUG_LIST_LIMIT rooms).
     """
-    # Update active users for each room
-    for room_id in rooms_db:
-        rooms_db[room_id].active_users = manager.get_active_users(room_id)
+    # Update active users for each listed room
+    rooms = await rooms_db.first(DEBUG_LIST_LIMIT)
+    counts = await manager.get_active_users_many([room.id for room in rooms])
+    for room, count in zip(rooms, counts):
+        room.active_users = count
     
     return {
-        "room_count": len(rooms_db),
-        "rooms": {id: room.dict() for id, room in rooms_db.items()}
+        "room_count": await rooms_db.count(),
+        "rooms": {room.id: room.model_dump() for room in rooms}
     }
 
 @app.get("/api/v1/debug/connections")
 async def debug_connections():
     """
-    Debug endpoint to view all WebSocket connections.
+    Debug endpoint to view WebSocket connections (first DEBUG_LIST_LIMIT rooms).
     """
-    connections = {}
-    
-    for room_id in manager.active_connections:
-        connections[room_id] = {}
-        for doc_id in manager.active_connections[room_id]:
-            connections[room_id][doc_id] = list(manager.active_connections[room_id][doc_id].keys())
+    # Snapshot up front so the response is built from a consistent view
+    connections = {
+        room_id: {
+            doc_id: list(manager.doc_clients.get((room_id, doc_id), ()))
+            for doc_id in list(docs)
+        }
+        for room_id, docs in islice(manager.room_docs.items(), DEBUG_LIST_LIMIT)
+    }
     
     return {
         "connections": connections
@@ -631,7 +1221,7 @@ if __name__ == "__main__":
         created_at=datetime.now().isoformat(),
         active_users=0
     )
-    rooms_db["1"] = sample_room
+    rooms_db.local["1"] = sample_room
     
     # Add rooms from your logs
     specific_room = Room(
@@ -641,7 +1231,7 @@ if __name__ == "__main__":
         created_at=datetime.now().isoformat(),
         active_users=0
     )
-    rooms_db["1744151147110"] = specific_room
+    rooms_db.local["1744151147110"] = specific_room
     
     specific_room2 = Room(
         id="1744151263756",
@@ -650,11 +1240,16 @@ if __name__ == "__main__":
         created_at=datetime.now().isoformat(),
         active_users=0
     )
-    rooms_db["1744151263756"] = specific_room2
+    rooms_db.local["1744151263756"] = specific_room2
     
+    # uvloop/httptools replace the pure-Python event loop and HTTP parser
     uvicorn.run(
         "main:app",
         host="127.0.0.1",
         port=8000,
-        reload=True
+        reload=True,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        log_level="info"
     )
\ No newline at end of file